@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark for the per-transaction bookkeeping done by MtmTxAggregate
+# in the MtmClient hot loop. Run from tests2 directory:
+#
+#   python3 bench_aggregate.py [iterations]
+#
+
+import psycopg2
+import sys
+import timeit
+
+from lib.bank_client import MtmTxAggregate, abort_classifier
+
+# psycopg2 only sets pgcode on errors coming from the server; subclasses
+# let the benchmark raise errors that look the same to the classifier
+class SerializationFailure(psycopg2.extensions.TransactionRollbackError):
+    pgcode = '40001'
+
+class MultimasterAbort(psycopg2.InternalError):
+    pgcode = 'XX000'
+
+def bench(iterations):
+    agg = MtmTxAggregate('bench')
+
+    def commit():
+        agg.start_tx()
+        agg.finish_tx('commit')
+
+    def aborter(error):
+        # same path as the except clause of MtmClient.exec_tx
+        def abort():
+            agg.start_tx()
+            try:
+                raise error
+            except psycopg2.Error as e:
+                msg = str(e).strip()
+                agg.finish_tx(abort_classifier.classify(e), msg)
+        return abort
+
+    serialization = aborter(SerializationFailure(
+        'could not serialize access due to concurrent update'))
+    mtm_abort = aborter(MultimasterAbort(
+        'Transaction MTM-1-12345-1 (7890) is aborted on node 2. Check its log to see error details.'))
+
+    for name, fn in [('commit', commit), ('abort', serialization), ('mtmabort', mtm_abort)]:
+        agg.clear_values()
+        # best of several runs to filter out scheduler noise
+        best = min(timeit.repeat(fn, number=iterations, repeat=5))
+        print("%-8s %8.1f ns/tx  %10.0f tx/s per core" %
+            (name, best * 1e9 / iterations, iterations / best))
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
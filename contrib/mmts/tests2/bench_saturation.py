@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Saturation search for a multimaster cluster. Steps the number of transfer
+# workers per node up (8, 16, 32, ...), holds every step for a while and
+# records throughput and p99 commit latency. Stops when throughput drops or
+# p99 crosses the SLO and reports the knee: the lowest concurrency that
+# gets within --drop of the best throughput seen within the SLO. Run from
+# tests2 directory, e.g.:
+#
+#   python3 bench_saturation.py -f support/two_nodes.yml --up
+#   python3 bench_saturation.py -f docker-compose.yml --slo 0.05
+#
+
+import argparse
+import json
+import time
+
+from lib.bank_client import MtmClient, LatencyHistogram
+from lib.cluster import ComposeCluster
+
+def measure(client, writers, warmup, hold, processes):
+    client.writers_per_node = writers
+    client.bgrun(processes=processes)
+    try:
+        time.sleep(warmup)
+        client.clean_aggregates()
+        started = time.time()
+        time.sleep(hold)
+        aggs = client.get_aggregates(_print=False)
+        elapsed = time.time() - started
+    finally:
+        client.stop()
+
+    commits = 0
+    aborts = 0
+    latency = LatencyHistogram()
+    for node_aggs in aggs:
+        agg = node_aggs['transfer']
+        commits += agg['finish'].get('commit', 0)
+        aborts += sum(count for status, count in agg['finish'].items() if status != 'commit')
+        latency.merge(agg['latency_hist'])
+
+    return {
+        'writers_per_node': writers,
+        'tps': commits / elapsed,
+        'aborts_per_sec': aborts / elapsed,
+        'p50': latency.percentile(50) / 1000000.0,
+        'p99': latency.percentile(99) / 1000000.0
+    }
+
+def saturation_search(client, args):
+    # returns (knee step or None, all measured steps)
+    results = []
+    best = None
+    writers = args.start
+
+    while writers <= args.max:
+        step = measure(client, writers, args.warmup, args.hold, args.processes)
+        results.append(step)
+        print("writers/node %4d: %9.1f tps, %7.1f aborts/s, p50 %.4fs, p99 %.4fs" %
+            (writers, step['tps'], step['aborts_per_sec'], step['p50'], step['p99']))
+
+        if step['p99'] > args.slo:
+            print('p99 latency crossed SLO of %.4fs' % args.slo)
+            break
+        if best is not None and step['tps'] < best['tps'] * (1 - args.drop):
+            print('throughput dropped by more than %d%%' % (args.drop * 100))
+            break
+        if best is None or step['tps'] > best['tps']:
+            best = step
+        writers *= 2
+
+    if best is None:
+        return None, results
+    knee = next(step for step in results
+        if step['p99'] <= args.slo and step['tps'] >= best['tps'] * (1 - args.drop))
+    return knee, results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the saturation point of a cluster.')
+    parser.add_argument('-f', '--compose-file', default='docker-compose.yml')
+    parser.add_argument('--up', action='store_true', help='(re)create the cluster first')
+    parser.add_argument('--accounts', type=int, default=100000)
+    parser.add_argument('--start', type=int, default=8, help='initial writers per node')
+    parser.add_argument('--max', type=int, default=1024, help='max writers per node')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds before each step')
+    parser.add_argument('--hold', type=float, default=20, help='seconds to measure each step')
+    parser.add_argument('--slo', type=float, default=0.1, help='p99 latency limit, seconds')
+    parser.add_argument('--drop', type=float, default=0.05, help='throughput drop to stop at')
+    parser.add_argument('--processes', type=int, default=None, help='load processes, default one per core')
+    parser.add_argument('--output', help='write all steps as JSON here')
+    args = parser.parse_args()
+
+    cluster = ComposeCluster(args.compose_file)
+    if args.up:
+        cluster.up()
+
+    client = MtmClient(cluster.dsns, n_accounts=args.accounts,
+        readers_per_node=0, fast_init=True)
+    knee, results = saturation_search(client, args)
+
+    if knee is None:
+        print('%s: no step met the SLO' % args.compose_file)
+    else:
+        print('%s: knee at %d writers per node, %.1f tps, p99 %.4fs' %
+            (args.compose_file, knee['writers_per_node'], knee['tps'], knee['p99']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'compose_file': args.compose_file, 'knee': knee, 'steps': results}, f, indent=2)
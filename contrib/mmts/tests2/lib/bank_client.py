@@ -2,7 +2,6 @@
 import asyncio
 # import uvloop
 import aiopg
-import random
 import psycopg2
 from psycopg2.extensions import *
 import time
@@ -12,43 +11,288 @@ import aioprocessing
 import multiprocessing
 import logging
 import re
+import array
+import threading
+import collections
+import csv
+import os
+import concurrent.futures
+
+from lib.connection_pool import pool
+from lib.workload import key_generator
+from lib.txlog import TxLogWriter
+
+# Monotonic nanosecond clock: immune to wall-clock jumps (see support/bumptime.c)
+# and cheap enough to be called twice per transaction.
+try:
+    now_ns = time.perf_counter_ns
+except AttributeError:
+    def now_ns():
+        return int(time.perf_counter() * 1000000000)
+
+class LatencyHistogram(object):
+    # HDR-style log-linear histogram over integer microseconds. Every power of
+    # two range is split into 2**(sub_bits - 1) linear sub-buckets, so relative
+    # error stays below 2**(1 - sub_bits) while memory is fixed by max_bits.
+    # Histograms with equal geometry can be merged by adding counters.
+
+    def __init__(self, sub_bits=7, max_bits=36):
+        self.sub_bits = sub_bits
+        self.max_bits = max_bits
+        self.half = 1 << (sub_bits - 1)
+        self.clear()
+
+    def clear(self):
+        self.counts = array.array('q', [0]) * ((self.max_bits - self.sub_bits + 2) * self.half)
+        self.total_count = 0
+        self.min_value = 0
+        self.max_value = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.sub_bits
+        if shift <= 0:
+            return value
+        index = shift * self.half + (value >> shift)
+        return min(index, len(self.counts) - 1)
+
+    def _value_at(self, index):
+        # highest value that falls into bucket 'index'
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        sub = index - shift * self.half
+        return ((sub + 1) << shift) - 1
+
+    def _used_range(self):
+        # only buckets between min and max can be non-empty
+        return range(self._index(self.min_value), self._index(self.max_value) + 1)
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        self.counts[self._index(value)] += 1
+        if self.total_count == 0 or value < self.min_value:
+            self.min_value = value
+        if value > self.max_value:
+            self.max_value = value
+        self.total_count += 1
+
+    def merge(self, other):
+        if (other.sub_bits, other.max_bits) != (self.sub_bits, self.max_bits):
+            raise ValueError('can not merge histograms with different geometry')
+        if other.total_count == 0:
+            return self
+        counts = self.counts
+        for i in other._used_range():
+            counts[i] += other.counts[i]
+        if self.total_count == 0 or other.min_value < self.min_value:
+            self.min_value = other.min_value
+        if other.max_value > self.max_value:
+            self.max_value = other.max_value
+        self.total_count += other.total_count
+        return self
+
+    def percentile(self, percent):
+        if self.total_count == 0:
+            return 0
+        rank = max(1, int(round(self.total_count * percent / 100.0)))
+        seen = 0
+        for i in self._used_range():
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self._value_at(i), self.max_value)
+        return self.max_value
+
+    def __getstate__(self):
+        # ship only non-empty buckets through pipes
+        state = self.__dict__.copy()
+        state['counts'] = [(i, self.counts[i]) for i in self._used_range() if self.counts[i]]
+        return state
+
+    def __setstate__(self, state):
+        sparse = state.pop('counts')
+        self.__dict__.update(state)
+        self.counts = array.array('q', [0]) * ((self.max_bits - self.sub_bits + 2) * self.half)
+        for i, count in sparse:
+            self.counts[i] = count
+
+    def as_dict(self):
+        return {
+            'count': self.total_count,
+            'min': self.min_value,
+            'max': self.max_value,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9)
+        }
+
+# Finished transactions are counted either as 'commit' or as one of these
+# abort reasons, so 'finish' dicts stay small whatever the error text is.
+ABORT_REASONS = ['serialization', 'deadlock', 'aborted_on_node', 'node_not_online',
+    'coordinator_disabled', 'connection', 'timeout', 'assertion', 'other']
+
+# raw error messages kept per aggregate and interval for debugging
+ABORT_SAMPLES = 8
+
+# seconds stop() waits for load processes to exit before killing them
+STOP_TIMEOUT = 10
+
+class AbortClassifier(object):
+    # Maps exceptions raised by a transaction to ABORT_REASONS. SQLSTATE is
+    # checked first with a dict lookup; multimaster raises its own aborts as
+    # internal errors, so those are told apart by one precompiled regex.
+
+    sqlstate_reasons = {
+        '40001': 'serialization',
+        '40P01': 'deadlock',
+        '57014': 'timeout',
+        '08000': 'connection',
+        '08001': 'connection',
+        '08003': 'connection',
+        '08006': 'connection',
+        '57P01': 'connection',
+        '57P02': 'connection',
+        '57P03': 'connection',
+    }
+
+    message_patterns = re.compile('|'.join([
+        r'(?P<aborted_on_node>is aborted on node)',
+        r'(?P<node_not_online>node is not online|because this cluster node is in)',
+        r'(?P<coordinator_disabled>coordinator \d+ was disabled)',
+        r'(?P<connection>connection|could not connect|terminating)',
+        r'(?P<timeout>timeout|timed out)',
+    ]))
+
+    def classify(self, error):
+        if isinstance(error, AssertionError):
+            return 'assertion'
+        if isinstance(error, asyncio.TimeoutError):
+            return 'timeout'
+
+        reason = self.sqlstate_reasons.get(getattr(error, 'pgcode', None))
+        if reason is not None:
+            return reason
+
+        m = self.message_patterns.search(str(error))
+        if m is not None:
+            return m.lastgroup
+        return 'other'
+
+abort_classifier = AbortClassifier()
 
 class MtmTxAggregate(object):
 
     def __init__(self, name):
         self.name = name
         self.isolation = 0
+        self.latency = LatencyHistogram()
         self.clear_values()
 
     def clear_values(self):
-        self.max_latency = 0.0
+        # all accumulators are plain integers in nanoseconds
+        self.max_latency_ns = 0
+        self.total_latency_ns = 0
+        self.n_tx = 0
+        self.latency.clear()
         self.finish = {}
+        self.abort_samples = []
 
-    def start_tx(self):
-        self.start_time = datetime.datetime.now()
+    def start_tx(self, start_ns=None):
+        self.start_ns = now_ns() if start_ns is None else start_ns
 
-    def finish_tx(self, status):
-        latency = (datetime.datetime.now() - self.start_time).total_seconds()
+    def finish_tx(self, status, message=None):
+        latency_ns = now_ns() - self.start_ns
 
-        if "is aborted on node" in status:
-            status = re.sub(r'MTM-.+\)', '<censored>', status)
+        if message is not None and len(self.abort_samples) < ABORT_SAMPLES:
+            self.abort_samples.append(message)
 
-        if latency > self.max_latency:
-            self.max_latency = latency
+        if latency_ns > self.max_latency_ns:
+            self.max_latency_ns = latency_ns
+        self.total_latency_ns += latency_ns
+        self.n_tx += 1
+        self.latency.record(latency_ns // 1000)
 
         if status not in self.finish:
             self.finish[status] = 1
         else:
             self.finish[status] += 1
 
-    def as_dict(self):
+        return latency_ns
+
+    def merge(self, other):
+        self.isolation += other.isolation
+        if other.max_latency_ns > self.max_latency_ns:
+            self.max_latency_ns = other.max_latency_ns
+        self.total_latency_ns += other.total_latency_ns
+        self.n_tx += other.n_tx
+        self.latency.merge(other.latency)
+        for status, count in other.finish.items():
+            self.finish[status] = self.finish.get(status, 0) + count
+        self.abort_samples.extend(other.abort_samples[:ABORT_SAMPLES - len(self.abort_samples)])
+        return self
+
+    def as_dict(self, with_hist=True):
         return {
-            'running_latency': 'xxx', #(datetime.datetime.now() - self.start_time).total_seconds(),
-            'max_latency': self.max_latency,
+            'running_latency': 'xxx', #(now_ns() - self.start_ns) / 1000000000.0,
+            'max_latency': self.max_latency_ns / 1000000000.0,
+            'avg_latency': self.total_latency_ns / max(self.n_tx, 1) / 1000000000.0,
+            'p50_latency': self.latency.percentile(50) / 1000000.0,
+            'p99_latency': self.latency.percentile(99) / 1000000.0,
+            'p999_latency': self.latency.percentile(99.9) / 1000000.0,
+            'latency_hist': copy.deepcopy(self.latency) if with_hist else None,
             'isolation': self.isolation,
-            'finish': copy.deepcopy(self.finish)
+            'finish': copy.deepcopy(self.finish),
+            'abort_samples': list(self.abort_samples)
         }
 
+# Statements of the bank workload: name -> (argument types, query).
+# In 'simple' query mode they are sent as text with client-side parameter
+# substitution; in 'prepared' mode they are PREPAREd once per connection
+# and run with EXECUTE, so the server skips parse/plan on every call.
+BANK_STATEMENTS = {
+    'debit': ('int, int',
+        'update bank_test set amount = amount - $1 where uid = $2'),
+    'credit': ('int, int',
+        'update bank_test set amount = amount + $1 where uid = $2'),
+    'transfer': ('int, int, int',
+        'select bank_transfer($1, $2, $3)'),
+    'total': (None,
+        "select sum(amount), count(*), count(uid), current_setting('multimaster.node_id') from bank_test"),
+}
+
+def bank_queries(query_mode):
+    queries = {}
+    for name, (argtypes, query) in BANK_STATEMENTS.items():
+        nargs = len(argtypes.split(',')) if argtypes else 0
+        if query_mode == 'simple':
+            queries[name] = re.sub(r'\$\d+', '%s', query)
+        elif query_mode == 'prepared':
+            if nargs:
+                queries[name] = 'execute bank_%s(%s)' % (name, ', '.join(['%s'] * nargs))
+            else:
+                queries[name] = 'execute bank_%s' % (name,)
+        else:
+            raise ValueError('unknown query mode %r' % (query_mode,))
+    return queries
+
+class AccountsStream(object):
+    # File-like source of 'uid<TAB>amount' lines for COPY, generated lazily
+    # so that big datasets never sit in client memory as a whole.
+
+    def __init__(self, n_accounts, chunk=65536):
+        self.next_uid = 0
+        self.last_uid = n_accounts
+        self.chunk = chunk
+
+    def read(self, size=-1):
+        if self.next_uid > self.last_uid:
+            return ''
+        end = min(self.next_uid + self.chunk, self.last_uid + 1)
+        data = ''.join(['%d\t0\n' % uid for uid in range(self.next_uid, end)])
+        self.next_uid = end
+        return data
+
 def keep_trying(tries, delay, method, name, *args, **kwargs):
     for t in range(tries):
         try:
@@ -60,14 +304,39 @@ def keep_trying(tries, delay, method, name, *args, **kwargs):
             time.sleep(delay)
     raise Exception("this should not happen")
 
+def subrange(lo, hi, fanout, part):
+    # [lo, hi) bounds of the uids that range_hashes() puts into 'part',
+    # i.e. of uid with (uid - lo) * fanout // (hi - lo) == part
+    return (lo + (part * (hi - lo) + fanout - 1) // fanout,
+        lo + ((part + 1) * (hi - lo) + fanout - 1) // fanout)
+
 class MtmClient(object):
 
-    def __init__(self, dsns, n_accounts=100000):
+    def __init__(self, dsns, n_accounts=100000, writers_per_node=1, readers_per_node=1,
+            query_mode='simple', single_roundtrip=False, status_interval=1.0,
+            series_file=None, fast_init=False, key_distribution='uniform', key_params=None,
+            seed=None, txlog_file=None, target_tps=None):
         # logging.basicConfig(level=logging.DEBUG)
         self.n_accounts = n_accounts
         self.dsns = dsns
+        self.writers_per_node = writers_per_node
+        self.readers_per_node = readers_per_node
+        self.query_mode = query_mode
+        self.queries = bank_queries(query_mode)
+        self.single_roundtrip = single_roundtrip
+        self.status_interval = status_interval
+        self.series_file = series_file
+        self.fast_init = fast_init
+        # see lib/workload.py, e.g. key_distribution='zipfian', key_params={'theta': 0.9}
+        self.key_distribution = key_distribution
+        self.key_params = key_params or {}
+        self.seed = seed
+        self.txlog_file = txlog_file
+        # transfers per second per node in open-loop mode, None for closed loop
+        self.target_tps = target_tps
         self.total = 0
         self.aggregates = {}
+        self.node_executor = None
         keep_trying(40, 1, self.initdb, 'self.initdb')
         self.running = True
         self.nodes_state_fields = ["id", "disabled", "disconnected", "catchUp", "slotLag",
@@ -100,91 +369,307 @@ class MtmClient(object):
 '''
 
     def initdb(self):
+        # Timings of every setup phase in seconds, kept in self.init_timings.
+        # With fast_init the table is loaded without index via COPY and the
+        # primary key is built afterwards, so rows are not replicated
+        # through index inserts one by one.
+        timings = self.init_timings = collections.OrderedDict()
+        started = now_ns()
+
+        def phase_done(name):
+            nonlocal started
+            timings[name] = (now_ns() - started) / 1000000000.0
+            started = now_ns()
+
         conn = psycopg2.connect(self.dsns[0])
         cur = conn.cursor()
         cur.execute('create extension if not exists multimaster')
         conn.commit()
         cur.execute('drop table if exists bank_test')
-        cur.execute('create table bank_test(uid int primary key, amount int)')
+        if self.fast_init:
+            cur.execute('create table bank_test(uid int not null, amount int)')
+        else:
+            cur.execute('create table bank_test(uid int primary key, amount int)')
+        # Server-side transfer used in single round trip mode. Row count
+        # checks are done here instead of client-side asserts.
         cur.execute('''
-                insert into bank_test
-                select *, 0 from generate_series(0, %s)''',
-                (self.n_accounts,))
+                create or replace function bank_transfer(from_uid int, to_uid int, delta int)
+                returns void as $$
+                begin
+                    update bank_test set amount = amount - delta where uid = from_uid;
+                    if not found then
+                        raise exception 'bank_transfer: no account %', from_uid;
+                    end if;
+                    update bank_test set amount = amount + delta where uid = to_uid;
+                    if not found then
+                        raise exception 'bank_transfer: no account %', to_uid;
+                    end if;
+                end
+                $$ language plpgsql''')
         conn.commit()
+        phase_done('create')
+
+        if self.fast_init:
+            cur.copy_expert('copy bank_test(uid, amount) from stdin',
+                AccountsStream(self.n_accounts), size=65536)
+            conn.commit()
+            phase_done('load')
+
+            cur.execute("set maintenance_work_mem = '1GB'")
+            cur.execute('alter table bank_test add primary key (uid)')
+            conn.commit()
+            phase_done('index')
+        else:
+            cur.execute('''
+                    insert into bank_test
+                    select *, 0 from generate_series(0, %s)''',
+                    (self.n_accounts,))
+            conn.commit()
+            phase_done('load')
+
+        # autovacuum would get there eventually, but the first seconds of
+        # the workload matter for the tests
+        conn.autocommit = True
+        cur.execute('analyze bank_test')
+        phase_done('analyze')
+
         cur.close()
         conn.close()
 
+        print('initdb: %d accounts, %s' % (self.n_accounts,
+            ', '.join('%s %.2fs' % (name, t) for name, t in timings.items())))
+
     def execute(self, node_id, statements):
-        con = psycopg2.connect(self.dsns[node_id])
-        con.autocommit = True
-        cur = con.cursor()
-        for statement in statements:
-            cur.execute(statement)
-        cur.close()
-        con.close()
+        with pool.connection(self.dsns[node_id]) as con:
+            cur = con.cursor()
+            for statement in statements:
+                cur.execute(statement)
+            cur.close()
 
     def is_data_identic(self):
-        hashes = set()
+        divergent = self.find_divergent_keys()
 
-        for dsn in self.dsns:
-            con = psycopg2.connect(dsn)
-            cur = con.cursor()
+        if divergent:
+            print('%d divergent accounts, first ones: %s' % (len(divergent), divergent[:20]))
+        else:
+            print('data is identic on all nodes')
+        return (len(divergent) == 0)
+
+    def find_divergent_keys(self, fanout=64, leaf_size=1024):
+        # Merkle-style comparison: every node hashes 'fanout' uid subranges
+        # of each suspicious range, and only subranges whose hashes differ
+        # are split further. Ranges of at most leaf_size uids are compared
+        # row by row. Nodes are queried in parallel; each keeps one
+        # repeatable read transaction, so all levels see the same snapshot.
+        conns = self.on_all_nodes(lambda node_id: pool.getconn(self.dsns[node_id]))
+        divergent = set()
+        broken = False
+
+        def on_all_nodes(method, *args):
+            return self.on_all_nodes(lambda node_id: method(conns[node_id], *args))
+
+        try:
+            for conn in conns:
+                conn.set_session(isolation_level='REPEATABLE READ', readonly=True,
+                    autocommit=False)
+
+            bounds = on_all_nodes(self.uid_bounds)
+            lows = [lo for lo, hi in bounds if lo is not None]
+            if not lows:
+                return []
+            ranges = [(min(lows), max(hi for lo, hi in bounds if hi is not None) + 1)]
+
+            while ranges:
+                leaves = [r for r in ranges if r[1] - r[0] <= leaf_size]
+                inner = [r for r in ranges if r[1] - r[0] > leaf_size]
+
+                if leaves:
+                    node_rows = on_all_nodes(self.range_rows, leaves)
+                    for uid in set().union(*[rows.keys() for rows in node_rows]):
+                        if len(set(rows.get(uid) for rows in node_rows)) > 1:
+                            divergent.add(uid)
+
+                ranges = []
+                if inner:
+                    node_hashes = on_all_nodes(self.range_hashes, inner, fanout)
+                    for i, (lo, hi) in enumerate(inner):
+                        parts = set().union(*[hashes[i].keys() for hashes in node_hashes])
+                        for part in parts:
+                            if len(set(hashes[i].get(part) for hashes in node_hashes)) > 1:
+                                ranges.append(subrange(lo, hi, fanout, part))
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            for node_id, conn in enumerate(conns):
+                pool.putconn(self.dsns[node_id], conn, broken)
+
+        return sorted(divergent)
+
+    def uid_bounds(self, conn):
+        cur = conn.cursor()
+        cur.execute('select min(uid), max(uid) from bank_test')
+        bounds = cur.fetchone()
+        cur.close()
+        return bounds
+
+    def range_hashes(self, conn, ranges, fanout):
+        # [{part: (count, md5)}] for every [lo, hi) range
+        cur = conn.cursor()
+        result = []
+        for lo, hi in ranges:
             cur.execute("""
                 select
-                    md5('(' || string_agg(uid::text || ', ' || amount::text , '),(') || ')')
-                from
-                    (select * from bank_test order by uid) t;""")
-            hashes.add(cur.fetchone()[0])
-            cur.close()
-            con.close()
+                    ((uid::bigint - %(lo)s) * %(fanout)s / (%(hi)s - %(lo)s))::int as part,
+                    count(*),
+                    md5(string_agg(uid::text || ', ' || amount::text, '),(' order by uid))
+                from bank_test
+                where uid >= %(lo)s and uid < %(hi)s
+                group by part""",
+                {'lo': lo, 'hi': hi, 'fanout': fanout})
+            result.append(dict((part, (count, md5)) for part, count, md5 in cur.fetchall()))
+        cur.close()
+        return result
 
-        print(hashes)
-        return (len(hashes) == 1)
+    def range_rows(self, conn, ranges):
+        cur = conn.cursor()
+        rows = {}
+        for lo, hi in ranges:
+            cur.execute('select uid, amount from bank_test where uid >= %s and uid < %s', (lo, hi))
+            rows.update(cur.fetchall())
+        cur.close()
+        return rows
 
     def no_prepared_tx(self):
-        n_prepared = 0
+        def count_prepared(node_id):
+            with pool.connection(self.dsns[node_id]) as con:
+                cur = con.cursor()
+                cur.execute("select count(*) from pg_prepared_xacts;")
+                count = int(cur.fetchone()[0])
+                cur.close()
+            return count
 
-        for dsn in self.dsns:
-            con = psycopg2.connect(dsn)
-            cur = con.cursor()
-            cur.execute("select count(*) from pg_prepared_xacts;")
-            n_prepared += int(cur.fetchone()[0])
-            cur.close()
-            con.close()
+        n_prepared = sum(self.on_all_nodes(count_prepared))
 
         print("n_prepared = %d" % (n_prepared))
         return (n_prepared)
 
+    def on_all_nodes(self, method, *args):
+        # Run method(node_id, *args) for every node at once and return the
+        # results in node order, so post-test checks take as long as the
+        # slowest node. psycopg2 releases the GIL while it waits for the
+        # server, so threads are enough.
+        if self.node_executor is None:
+            self.node_executor = concurrent.futures.ThreadPoolExecutor(len(self.dsns))
+        futures = [self.node_executor.submit(method, node_id, *args)
+            for node_id in range(len(self.dsns))]
+        return [f.result() for f in futures]
+
     @asyncio.coroutine
     def status(self):
         while self.running:
             msg = yield from self.child_pipe.coro_recv()
-            if msg == 'status' or msg == 'status_noclean':
-                serialized_aggs = []
-
-                for conn_id, conn_aggs in self.aggregates.items():
-                    serialized_aggs.append({})
-                    for aggname, agg in conn_aggs.items():
-                        serialized_aggs[conn_id][aggname] = agg.as_dict()
-                        if msg == 'status':
-                            agg.clear_values()
-
-                yield from self.child_pipe.coro_send(serialized_aggs)
+            if isinstance(msg, tuple) and msg[0] == 'flush':
+                self.push_status(msg[1])
+            elif msg == ('stop',):
+                # Push the last deltas and leave run(); the queue feeder
+                # thread is joined on process exit, so they are delivered.
+                self.running = False
+                self.push_status()
+                if self.txlog is not None:
+                    self.txlog.close()
+                    self.txlog = None
+                self.loop.stop()
             else:
                 print('evloop: unknown message')
 
     @asyncio.coroutine
-    def exec_tx(self, tx_block, aggname_prefix, conn_i):
-        aggname = "%s_%i" % (aggname_prefix, conn_i)
-        if conn_i not in self.aggregates:
-            self.aggregates[conn_i] = {}
-        agg = self.aggregates[conn_i][aggname_prefix] = MtmTxAggregate(aggname)
+    def publish(self):
+        while self.running:
+            yield from asyncio.sleep(self.status_interval)
+            self.push_status()
+            if self.txlog is not None:
+                self.txlog.flush()
+
+    def push_status(self, token=None):
+        # Queue.put() only hands the sample to a feeder thread, so the event
+        # loop never waits for the test process.
+        self.status_queue.put({
+            'time': time.time(),
+            'process': self.process_i,
+            'token': token,
+            'aggs': self.collect_aggregates()
+        })
+
+    def collect_aggregates(self):
+        # Every worker has its own aggregate slot; merge them into one delta
+        # aggregate per node and workload and start a new interval. The test
+        # process sums deltas, so it sees the same shape regardless of
+        # fan-out and of the number of load processes.
+        collected = {}
+
+        for conn_id, conn_aggs in self.aggregates.items():
+            collected[conn_id] = {}
+            for aggname, workers in conn_aggs.items():
+                merged = MtmTxAggregate(aggname)
+                for agg in workers:
+                    merged.merge(agg)
+                    agg.clear_values()
+                    agg.isolation = 0
+                collected[conn_id][aggname] = merged
+
+        return collected
+
+    @asyncio.coroutine
+    def exec_tx(self, tx_block, aggname_prefix, conn_i, worker_i=0):
+        aggname = "%s_%i_%i" % (aggname_prefix, conn_i, worker_i)
+        conn_aggs = self.aggregates.setdefault(conn_i, {})
+        agg = MtmTxAggregate(aggname)
+        conn_aggs.setdefault(aggname_prefix, []).append(agg)
         dsn = self.dsns[conn_i]
 
-        conn = cur = False
+        # Keys of every worker come from their own stream seeded with
+        # (seed, node, worker), so the key sequence of a worker does not
+        # depend on event loop timing or on the number of load processes.
+        keys = None
+        if aggname_prefix == 'transfer':
+            seed = None if self.seed is None else [self.seed, conn_i, worker_i]
+            params = dict({'block_size': 8192}, **self.key_params)
+            keys = key_generator(self.key_distribution, self.n_accounts, seed=seed, **params)
+        pair = None
+        seq = 0
+
+        # In open-loop mode transfers follow a fixed schedule and latency is
+        # measured from the intended start time. A stalled transaction then
+        # shows up in the latency of every transaction scheduled behind it,
+        # instead of silently lowering the offered load (coordinated
+        # omission). Workers of a node are staggered over one interval.
+        interval_ns = None
+        if self.target_tps and aggname_prefix == 'transfer':
+            interval_ns = int(1000000000 * self.writers_per_node / self.target_tps)
+            intended_ns = now_ns() + interval_ns * worker_i // self.writers_per_node
+
+        def finish(outcome, msg=None):
+            latency_ns = agg.finish_tx(outcome, msg)
+            if self.txlog is not None:
+                self.txlog.write(aggname_prefix, conn_i, worker_i, seq, pair, outcome,
+                    agg.start_ns, agg.start_ns + latency_ns)
+
+        conn = cur = prepared_conn = False
 
         while self.running:
-            agg.start_tx()
+            if keys is not None:
+                pair = keys.next_pair()
+            seq += 1
+
+            if interval_ns is not None:
+                delay_ns = intended_ns - now_ns()
+                if delay_ns > 0:
+                    yield from asyncio.sleep(delay_ns / 1000000000.0)
+                agg.start_tx(intended_ns)
+                intended_ns += interval_ns
+            else:
+                agg.start_tx()
 
             try:
                 if (not conn) or conn.closed:
@@ -192,7 +677,7 @@ class MtmClient(object):
                         # which in case of select's failure will lead to exception
                         # and stale connection to the database
                         conn = yield from aiopg.connect(dsn, enable_hstore=False, timeout=1)
-                        print('Connected %s, %d' % (aggname_prefix, conn_i + 1) )
+                        print('Connected %s, %d, worker %d' % (aggname_prefix, conn_i + 1, worker_i) )
 
                 if (not cur) or cur.closed:
                         # big timeout here is important because on timeout
@@ -201,6 +686,12 @@ class MtmClient(object):
                         # blocks evloop
                         cur = yield from conn.cursor(timeout=3600)
 
+                # Prepared statements live as long as the backend, so
+                # re-prepare them after every reconnect.
+                if prepared_conn is not conn:
+                    yield from self.prepare_tx(cur)
+                    prepared_conn = conn
+
                 # ROLLBACK tx after previous exception.
                 # Doing this here instead of except handler to stay inside try
                 # block.
@@ -208,12 +699,12 @@ class MtmClient(object):
                 if status != TRANSACTION_STATUS_IDLE:
                     yield from cur.execute('rollback')
 
-                yield from tx_block(conn, cur, agg, conn_i)
-                agg.finish_tx('commit')
+                yield from tx_block(conn, cur, agg, conn_i, pair)
+                finish('commit')
 
             except psycopg2.Error as e:
                 msg = str(e).strip()
-                agg.finish_tx(msg)
+                finish(abort_classifier.classify(e), msg)
                 # Give evloop some free time.
                 # In case of continuous excetions we can loop here without returning
                 # back to event loop and block it
@@ -221,7 +712,7 @@ class MtmClient(object):
 
             except BaseException as e:
                 msg = str(e).strip()
-                agg.finish_tx(msg)
+                finish(abort_classifier.classify(e), msg)
                 print('Caught exception %s, %s, %d, %s' % (type(e), aggname_prefix, conn_i + 1, msg) )
 
                 # Give evloop some free time.
@@ -232,27 +723,40 @@ class MtmClient(object):
         print("We've count to infinity!")
 
     @asyncio.coroutine
-    def transfer_tx(self, conn, cur, agg, conn_i):
+    def prepare_tx(self, cur):
+        if self.query_mode != 'prepared':
+            return
+        # An earlier attempt on this connection may have failed halfway,
+        # e.g. with multimaster rejecting statements while the node is not
+        # online; start from a clean slate so it can be retried.
+        yield from cur.execute('deallocate all')
+        for name, (argtypes, query) in BANK_STATEMENTS.items():
+            if argtypes:
+                yield from cur.execute('prepare bank_%s(%s) as %s' % (name, argtypes, query))
+            else:
+                yield from cur.execute('prepare bank_%s as %s' % (name, query))
+
+    @asyncio.coroutine
+    def transfer_tx(self, conn, cur, agg, conn_i, pair):
         amount = 1
-        # to avoid deadlocks:
-        from_uid = random.randint(1, self.n_accounts - 2)
-        to_uid = from_uid + 1
+        from_uid, to_uid = pair
+
+        if self.single_roundtrip:
+            # One implicit transaction, so the only round trip left is the
+            # one that carries the multimaster commit.
+            yield from cur.execute(self.queries['transfer'], (from_uid, to_uid, amount))
+            return
+
         yield from cur.execute('begin')
-        yield from cur.execute('''update bank_test
-            set amount = amount - %s
-            where uid = %s''',
-            (amount, from_uid))
+        yield from cur.execute(self.queries['debit'], (amount, from_uid))
         assert(cur.rowcount == 1)
-        yield from cur.execute('''update bank_test
-            set amount = amount + %s
-            where uid = %s''',
-            (amount, to_uid))
+        yield from cur.execute(self.queries['credit'], (amount, to_uid))
         assert(cur.rowcount == 1)
         yield from cur.execute('commit')
 
     @asyncio.coroutine
-    def total_tx(self, conn, cur, agg, conn_i):
-        yield from cur.execute("select sum(amount), count(*), count(uid), current_setting('multimaster.node_id') from bank_test")
+    def total_tx(self, conn, cur, agg, conn_i, pair=None):
+        yield from cur.execute(self.queries['total'])
         total = yield from cur.fetchone()
         if total[0] != self.total:
             agg.isolation += 1
@@ -267,48 +771,258 @@ class MtmClient(object):
             #          print("%19s" % nodes_state[j][i], end="\t")
             #     print("\n")
 
-    def run(self):
+    def workers(self):
+        workers = []
+        for i, _ in enumerate(self.dsns):
+            for w in range(self.writers_per_node):
+                workers.append(('transfer', i, w))
+            for r in range(self.readers_per_node):
+                workers.append(('sumtotal', i, r))
+        return workers
+
+    def run(self, workers=None, child_pipe=None, process_i=0):
         # asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
         self.loop = asyncio.get_event_loop()
+        tx_blocks = {'transfer': self.transfer_tx, 'sumtotal': self.total_tx}
 
-        for i, _ in enumerate(self.dsns):
-            asyncio.ensure_future(self.exec_tx(self.transfer_tx, 'transfer', i))
-            asyncio.ensure_future(self.exec_tx(self.total_tx, 'sumtotal', i))
+        if workers is None:
+            workers = self.workers()
+        if child_pipe is not None:
+            self.child_pipe = child_pipe
+            pool.after_fork()
+        self.process_i = process_i
+        self.txlog = None
+        if self.txlog_file is not None:
+            self.txlog = TxLogWriter('%s.%d' % (self.txlog_file, process_i),
+                self.seed, ABORT_REASONS, now_ns)
+
+        for aggname_prefix, conn_i, worker_i in workers:
+            asyncio.ensure_future(self.exec_tx(tx_blocks[aggname_prefix],
+                aggname_prefix, conn_i, worker_i))
 
         asyncio.ensure_future(self.status())
+        asyncio.ensure_future(self.publish())
 
         self.loop.run_forever()
 
-    def bgrun(self):
-        print('Starting evloop in different process')
-        self.parent_pipe, self.child_pipe = aioprocessing.AioPipe()
-        self.evloop_process = multiprocessing.Process(target=self.run, args=())
-        self.evloop_process.start()
+    def bgrun(self, processes=1):
+        # With processes=None load is sharded over one process per core.
+        # Workers are dealt round-robin, so connections of every node are
+        # spread evenly.
+        workers = self.workers()
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, len(workers)))
+
+        # Load processes push aggregate deltas every status_interval into
+        # status_queue; collector thread sums them and keeps a time series.
+        self.status_queue = multiprocessing.Queue()
+        self.status_cond = threading.Condition()
+        self.accumulated = {}
+        self.series = collections.deque(maxlen=100000)
+        self.flushed = {}
+        self.flush_token = 0
+        # Transfer commits of every node since bgrun() and their history as
+        # (sample time, commits) points; never reset by clean_aggregates().
+        self.commit_counts = [0] * len(self.dsns)
+        self.commit_history = [collections.deque(maxlen=10000) for dsn in self.dsns]
+        self.running = True
+
+        print('Starting evloop in %d different process(es)' % processes)
+        self.parent_pipes = []
+        self.evloop_processes = []
+        for k in range(processes):
+            parent_pipe, child_pipe = aioprocessing.AioPipe()
+            evloop_process = multiprocessing.Process(target=self.run,
+                args=(workers[k::processes], child_pipe, k))
+            evloop_process.start()
+            self.parent_pipes.append(parent_pipe)
+            self.evloop_processes.append(evloop_process)
+
+        self.collector = threading.Thread(target=self.collect_status)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def collect_status(self):
+        buckets = {}
+
+        while True:
+            sample = self.status_queue.get()
+            if sample is None:
+                self.write_series(buckets, None)
+                return
+
+            with self.status_cond:
+                point = {'time': sample['time'], 'process': sample['process'], 'aggs': []}
+                for conn_id in range(len(self.dsns)):
+                    point['aggs'].append({})
+                    node_aggs = self.accumulated.setdefault(conn_id, {})
+                    for aggname, agg in sample['aggs'].get(conn_id, {}).items():
+                        summary = agg.as_dict(with_hist=False)
+                        point['aggs'][conn_id][aggname] = summary
+                        if aggname not in node_aggs:
+                            node_aggs[aggname] = MtmTxAggregate(aggname)
+                        node_aggs[aggname].merge(agg)
+                        if aggname == 'transfer':
+                            self.commit_counts[conn_id] += agg.finish.get('commit', 0)
+                    self.commit_history[conn_id].append((sample['time'], self.commit_counts[conn_id]))
+                self.series.append(point)
+
+                if sample['token'] is not None:
+                    self.flushed[sample['token']] = self.flushed.get(sample['token'], 0) + 1
+                self.status_cond.notify_all()
+
+            if self.series_file:
+                # Sum deltas of all load processes into one-second buckets.
+                second = int(sample['time'])
+                bucket = buckets.setdefault(second, {})
+                for conn_id, conn_aggs in sample['aggs'].items():
+                    for aggname, agg in conn_aggs.items():
+                        key = (conn_id, aggname)
+                        if key in bucket:
+                            bucket[key].merge(agg)
+                        else:
+                            bucket[key] = agg
+                # Every process pushes at least once per status_interval, so
+                # older buckets can not get more samples.
+                self.write_series(buckets, sample['time'] - 1 - 2 * self.status_interval)
+
+    series_columns = ['time', 'node', 'aggname', 'commits', 'aborts', 'isolation',
+        'avg_latency', 'p50_latency', 'p99_latency', 'p999_latency', 'max_latency'
+        ] + ABORT_REASONS
+
+    def write_series(self, buckets, before):
+        # Append closed one-second buckets to series_file as CSV rows. Rows
+        # are only ever appended, so the file can be plotted while the test
+        # is still running.
+        closed = sorted(second for second in buckets if before is None or second < before)
+        if not closed or not self.series_file:
+            return
+
+        new_file = not os.path.exists(self.series_file) or os.path.getsize(self.series_file) == 0
+        with open(self.series_file, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(self.series_columns)
+            for second in closed:
+                for (conn_id, aggname), agg in sorted(buckets.pop(second).items()):
+                    row = agg.as_dict(with_hist=False)
+                    commits = row['finish'].get('commit', 0)
+                    writer.writerow([second, conn_id + 1, aggname, commits,
+                        agg.n_tx - commits, row['isolation'],
+                        '%.6f' % row['avg_latency'], '%.6f' % row['p50_latency'],
+                        '%.6f' % row['p99_latency'], '%.6f' % row['p999_latency'],
+                        '%.6f' % row['max_latency']
+                        ] + [row['finish'].get(reason, 0) for reason in ABORT_REASONS])
+
+    def flush_status(self):
+        # Make every load process cut its current interval right now and
+        # wait until those deltas are summed, so that clean_aggregates()
+        # and get_aggregates() see an exact boundary.
+        with self.status_cond:
+            self.flush_token += 1
+            token = self.flush_token
+
+        for parent_pipe in self.parent_pipes:
+            parent_pipe.send(('flush', token))
+
+        with self.status_cond:
+            while self.flushed.get(token, 0) < len(self.parent_pipes):
+                self.status_cond.wait()
+            del self.flushed[token]
+
+    def commit_rate(self, conn_id, window=1.0):
+        # Transfer commits per second of a node over the last window seconds
+        # of status samples, 0 until there is that much history.
+        with self.status_cond:
+            history = self.commit_history[conn_id]
+            if not history:
+                return 0.0
+            end_time, end_count = history[-1]
+            for sample_time, count in reversed(history):
+                if sample_time <= end_time - window:
+                    return (end_count - count) / (end_time - sample_time)
+            return 0.0
+
+    def wait_for_commits(self, conn_id, n_commits, timeout=None):
+        # Block until a node commits n_commits more transfers. Returns the
+        # seconds waited, or None on timeout. The collector wakes waiters on
+        # every status sample, so the wait is as precise as status_interval.
+        started = time.time()
+        with self.status_cond:
+            target = self.commit_counts[conn_id] + n_commits
+            if not self.status_cond.wait_for(
+                    lambda: self.commit_counts[conn_id] >= target, timeout):
+                return None
+        return time.time() - started
+
+    def wait_for_commit_rate(self, conn_id, rate, window=1.0, timeout=None):
+        # Like wait_for_commits(), until the commit rate of a node over the
+        # last window seconds reaches rate, e.g. a share of its rate
+        # measured by commit_rate() before a failure.
+        started = time.time()
+        with self.status_cond:
+            if not self.status_cond.wait_for(
+                    lambda: self.commit_rate(conn_id, window) >= rate, timeout):
+                return None
+        return time.time() - started
+
+    def get_series(self):
+        # Per-process, per-interval aggregate deltas collected so far.
+        with self.status_cond:
+            return list(self.series)
 
     def get_aggregates(self, _print=True, clean=True):
-        if clean:
-            self.parent_pipe.send('status')
-        else:
-            self.parent_pipe.send('status_noclean')
+        self.flush_status()
 
-        resp = self.parent_pipe.recv()
+        with self.status_cond:
+            resp = [
+                dict((aggname, agg.as_dict()) for aggname, agg in self.accumulated.get(conn_id, {}).items())
+                for conn_id in range(len(self.dsns))
+            ]
+            if clean:
+                self.reset_accumulated()
 
         if _print:
             MtmClient.print_aggregates(resp)
         return resp
 
     def clean_aggregates(self):
-        self.parent_pipe.send('status')
-        self.parent_pipe.recv()
+        self.flush_status()
+
+        with self.status_cond:
+            self.reset_accumulated()
+
+    def reset_accumulated(self):
+        # isolation errors are reported cumulatively, as before
+        for node_aggs in self.accumulated.values():
+            for agg in node_aggs.values():
+                agg.clear_values()
 
     def stop(self):
+        # Ask load processes to exit on their own. Killing a process while
+        # its feeder thread writes to status_queue may corrupt the queue,
+        # so terminate() is only a fallback for a stuck process.
         self.running = False
-        self.evloop_process.terminate()
-        time.sleep(3)
+        for parent_pipe in self.parent_pipes:
+            parent_pipe.send(('stop',))
+
+        deadline = time.time() + STOP_TIMEOUT
+        for evloop_process in self.evloop_processes:
+            evloop_process.join(max(0, deadline - time.time()))
+            if evloop_process.is_alive():
+                print('evloop process %d did not stop, terminating it' % evloop_process.pid)
+                evloop_process.terminate()
+                evloop_process.join()
+
+        # every sample is queued by now; let the collector drain them
+        self.status_queue.put(None)
+        self.collector.join(STOP_TIMEOUT)
 
     @classmethod
     def print_aggregates(cls, aggs):
-            columns = ['running_latency', 'max_latency', 'isolation', 'finish']
+            columns = ['running_latency', 'max_latency', 'avg_latency', 'p50_latency',
+                'p99_latency', 'p999_latency', 'isolation', 'finish']
 
             # print table header
             print("\t\t", end="")
@@ -0,0 +1,198 @@
+import docker
+import hashlib
+import os
+import re
+import shutil
+import socket
+import subprocess
+import yaml
+
+# ${VAR:-default} substitution of compose files (file format 2.1)
+VARIABLE = re.compile(r'\$\{(\w+):-([^}]*)\}')
+
+# images and data directory snapshots are kept here, for the last
+# CACHE_KEEP image hashes used
+CACHE_DIR = os.environ.get('MTM_CACHE_DIR', os.path.expanduser('~/.cache/mtm-tests'))
+CACHE_KEEP = 3
+
+# libfaketime settings passed to nodes when clock skew tests are enabled
+# with MTM_TEST_CLOCK_SKEW; without them nodes run on real time
+FAKETIME_ENV = {
+    'MTM_FAKETIME_PRELOAD': '/usr/local/lib/libfaketime.so.1',
+    'MTM_FAKETIME_FILE': '/pg/faketime',
+    'MTM_FAKETIME_CACHE_DURATION': '1',
+    'MTM_FAKETIME_DONT_FAKE_MONOTONIC': '1'
+}
+
+def source_hash(path):
+    # Hash of a docker build context, build products and caches excluded.
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != '__pycache__')
+        for name in sorted(files):
+            if name.endswith(('.o', '.so', '.pyc')):
+                continue
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+def base_image(path):
+    # the image named in FROM line of the Dockerfile
+    with open(os.path.join(path, 'Dockerfile')) as f:
+        for line in f:
+            if line.strip().upper().startswith('FROM '):
+                return line.split()[1]
+
+def free_port():
+    # let the kernel pick a port nobody listens on
+    with socket.socket() as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+class ComposeCluster(object):
+    # A docker-compose project of multimaster nodes. Compose files take
+    # container names and host ports from MTM_PREFIX and MTM_<SERVICE>_PORT,
+    # with defaults used by a plain 'docker-compose up'. When a project name
+    # is given, containers are named <project>_<service> and every node gets
+    # a free host port, so several test classes can run side by side.
+    #
+    # The image is built once per hash of its sources and the base image
+    # ID and tagged with it (MTM_IMAGE), so pulling a new base rebuilds
+    # it. Data directories of a freshly initialized cluster can be saved
+    # with snapshot(); later up() calls restore them into new containers
+    # instead of running initdb and setting up multimaster. A snapshot of
+    # all services appears in the cache at once, so classes sharing a
+    # compose file never restore nodes of two different clusters.
+
+    def __init__(self, compose_file, project=None):
+        self.compose_file = compose_file
+        self.project = project
+        self.env = dict(os.environ)
+        self.docker_api = docker.from_env()
+        with open(compose_file) as f:
+            compose = f.read()
+        self.services = yaml.safe_load(compose)['services']
+
+        # all services are built from the same context
+        build = next(service['build'] for service in self.services.values())
+        self.build_context = os.path.join(os.path.dirname(compose_file), build)
+        try:
+            base_id = self.docker_api.images.get(base_image(self.build_context)).id
+        except docker.errors.ImageNotFound:
+            # docker build pulls it; the tag changes once it is here
+            base_id = 'none'
+        self.image = 'mtm:' + hashlib.sha1((source_hash(self.build_context)
+            + base_id).encode()).hexdigest()[:16]
+        self.env['MTM_IMAGE'] = self.image
+        if os.environ.get('MTM_TEST_CLOCK_SKEW'):
+            self.env.update(FAKETIME_ENV)
+        self.snapshot_dir = os.path.join(CACHE_DIR, self.image.split(':')[1],
+            hashlib.sha1(compose.encode()).hexdigest()[:16])
+
+        if project is not None:
+            # compose itself keeps only lowercase letters and digits
+            self.project = re.sub('[^a-z0-9]', '', project.lower())
+            self.env['MTM_PREFIX'] = self.project + '_'
+            for service in self.services.values():
+                for port in service.get('ports', []):
+                    for var, default in VARIABLE.findall(port):
+                        self.env[var] = str(free_port())
+
+    def expand(self, value):
+        return VARIABLE.sub(lambda m: self.env.get(m.group(1)) or m.group(2), str(value))
+
+    def container(self, service):
+        return self.expand(self.services[service].get('container_name', service))
+
+    def port(self, service):
+        return int(self.expand(self.services[service]['ports'][0]).split(':')[0])
+
+    def dsn(self, service):
+        return "dbname=regression user=postgres host=127.0.0.1 port=%d" % self.port(service)
+
+    @property
+    def nodes(self):
+        # multimaster services, referee excluded
+        return [name for name in sorted(self.services)
+            if not self.services[name].get('environment', {}).get('REFEREE')
+                and self.services[name].get('ports')]
+
+    @property
+    def dsns(self):
+        return [self.dsn(node) for node in self.nodes]
+
+    def compose(self, *args):
+        command = ['docker-compose', '-f', self.compose_file]
+        if self.project is not None:
+            command += ['-p', self.project]
+        subprocess.check_call(command + list(args), env=self.env)
+
+    def build(self):
+        try:
+            self.docker_api.images.get(self.image)
+        except docker.errors.ImageNotFound:
+            subprocess.check_call(['docker', 'build', '-t', self.image, self.build_context])
+
+    def snapshot_file(self, service):
+        return os.path.join(self.snapshot_dir, service + '.tar')
+
+    def up(self, restore=True):
+        # Returns True if data directories were restored from a snapshot.
+        self.build()
+
+        if not restore or not os.path.isdir(self.snapshot_dir):
+            self.compose('up', '--force-recreate', '-d')
+            return False
+
+        # mark the image hash as used, see prune_cache()
+        os.utime(os.path.dirname(self.snapshot_dir))
+        self.compose('create', '--force-recreate')
+        for service in self.services:
+            with open(self.snapshot_file(service), 'rb') as f:
+                self.docker_api.containers.get(self.container(service)).put_archive('/pg', f.read())
+        self.compose('start')
+        return True
+
+    def snapshot(self):
+        # Stop all nodes at once so that the data directories are
+        # consistent with each other, save them and start nodes again.
+        containers = [self.docker_api.containers.get(self.container(service))
+            for service in self.services]
+        for container in containers:
+            container.exec_run('pg_ctl -m fast stop', user='postgres', detach=True)
+        for container in containers:
+            container.wait()
+
+        # several classes may snapshot at once: write all tarballs aside
+        # and move them into place with one rename, the first one wins
+        tmp_dir = '%s.%d' % (self.snapshot_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        try:
+            for service, container in zip(self.services, containers):
+                stream, stat = container.get_archive('/pg/data')
+                with open(os.path.join(tmp_dir, service + '.tar'), 'wb') as f:
+                    for chunk in stream:
+                        f.write(chunk)
+            try:
+                os.rename(tmp_dir, self.snapshot_dir)
+            except OSError:
+                if not os.path.isdir(self.snapshot_dir):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.compose('start')
+        self.prune_cache()
+
+    def prune_cache(self):
+        # Drop snapshots of all but the CACHE_KEEP most recently used image
+        # hashes; every source change leaves a full set behind otherwise.
+        used = sorted(os.listdir(CACHE_DIR), reverse=True,
+            key=lambda name: os.path.getmtime(os.path.join(CACHE_DIR, name)))
+        for name in used[CACHE_KEEP:]:
+            shutil.rmtree(os.path.join(CACHE_DIR, name), ignore_errors=True)
+
+    def down(self):
+        self.compose('down')
@@ -0,0 +1,96 @@
+import threading
+import contextlib
+import select
+import psycopg2
+from psycopg2.extensions import *
+
+class ConnectionPool(object):
+    # Idle psycopg2 connections kept per DSN and shared by helper queries of
+    # MtmClient and TestHelper, so that every helper call does not pay for
+    # a new multimaster backend.
+
+    def __init__(self, max_idle=4, connect_timeout=5):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.inherited = []
+        self.max_idle = max_idle
+        # TCP keepalives make the kernel notice a partitioned node in a few
+        # seconds, and the health check below then drops such connections.
+        self.connect_args = {
+            'connect_timeout': connect_timeout,
+            'keepalives': 1,
+            'keepalives_idle': 2,
+            'keepalives_interval': 1,
+            'keepalives_count': 3
+        }
+
+    def healthy(self, conn):
+        # Cheap check without a round trip. libpq marks a connection bad as
+        # soon as a read or write on its socket fails, and an idle backend
+        # sends nothing unless it is terminating or its socket got an error
+        # (e.g. keepalive timeout behind a partition).
+        if conn.closed or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        readable, _, _ = select.select([conn], [], [], 0)
+        return not readable
+
+    def getconn(self, dsn):
+        with self.lock:
+            conns = self.idle.get(dsn, [])
+            while conns:
+                conn = conns.pop()
+                if self.healthy(conn):
+                    return conn
+                conn.close()
+
+        return psycopg2.connect(dsn, **self.connect_args)
+
+    def putconn(self, dsn, conn, broken=False):
+        if not broken and self.healthy(conn):
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+
+        with self.lock:
+            conns = self.idle.setdefault(dsn, [])
+            if not broken and self.healthy(conn) and len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    @contextlib.contextmanager
+    def connection(self, dsn, autocommit=True, isolation_level='DEFAULT', readonly='DEFAULT'):
+        conn = self.getconn(dsn)
+        try:
+            conn.set_session(isolation_level=isolation_level, readonly=readonly,
+                autocommit=autocommit)
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(dsn, conn, broken=True)
+            raise
+        except BaseException:
+            self.putconn(dsn, conn)
+            raise
+        else:
+            self.putconn(dsn, conn)
+
+    def discard(self, dsn=None):
+        # Close idle connections to one node, or to all of them.
+        with self.lock:
+            dsns = list(self.idle) if dsn is None else [dsn]
+            conns = [conn for d in dsns for conn in self.idle.pop(d, [])]
+        for conn in conns:
+            conn.close()
+
+    def after_fork(self):
+        # Sockets inherited by a child process still belong to the parent.
+        # Closing them here would send Terminate to the parent's backends, so
+        # just keep them referenced and never use them.
+        with self.lock:
+            for conns in self.idle.values():
+                self.inherited.extend(conns)
+            self.idle = {}
+
+pool = ConnectionPool()
@@ -1,4 +1,5 @@
 import docker
+import time
 
 class FailureInjector(object):
 
@@ -7,7 +8,30 @@ class FailureInjector(object):
 
     def container_exec(self, node, command):
         docker_node = self.docker_api.containers.get(node)
-        docker_node.exec_run(command, user='root')
+        return docker_node.exec_run(command, user='root')
+
+    def exec_script(self, node, what, script):
+        # Run a shell script on a node in one docker exec. Tools used here
+        # are silent on success, so any output is an error. Returns the
+        # wall clock time right after the call; the script ran within the
+        # printed window before it.
+        started = time.time()
+        output = self.container_exec(node, ['sh', '-c', script])
+        applied = time.time()
+        if output.strip():
+            raise RuntimeError('%s on %s failed: %s' %
+                (what, node, output.decode(errors='replace').strip()))
+        print('Applied %s on %s at %.6f, window %.3fs' %
+            (what, node, applied, applied - started))
+        return applied
+
+    def apply_rules(self, node, action, rules):
+        # Add (action 'A') or delete ('D') iptables filter rules on a node
+        # with one iptables-restore call, so that they all take effect at
+        # once.
+        script = '*filter\n%sCOMMIT\n' % ''.join('-%s %s\n' % (action, rule) for rule in rules)
+        return self.exec_script(node, '%d iptables rule(s)' % len(rules),
+            'iptables-restore --noflush <<EOF\n%sEOF' % script)
 
 class NoFailure(FailureInjector):
 
@@ -23,14 +47,15 @@ class SingleNodePartition(FailureInjector):
         self.node = node
         super().__init__()
 
+    def rules(self):
+        return ["INPUT -j DROP", "OUTPUT -j DROP"]
+
     def start(self):
         # XXX: try reject too
-        self.container_exec(self.node, "iptables -A INPUT -j DROP")
-        self.container_exec(self.node, "iptables -A OUTPUT -j DROP")
+        self.started_at = self.apply_rules(self.node, 'A', self.rules())
 
     def stop(self):
-        self.container_exec(self.node, "iptables -D INPUT -j DROP")
-        self.container_exec(self.node, "iptables -D OUTPUT -j DROP")
+        self.stopped_at = self.apply_rules(self.node, 'D', self.rules())
 
 
 class EdgePartition(FailureInjector):
@@ -40,13 +65,85 @@ class EdgePartition(FailureInjector):
         self.nodeB = nodeB
         super().__init__()
 
+    def rules(self):
+        return ["INPUT -s {} -j DROP".format(self.nodeB),
+            "OUTPUT -d {} -j DROP".format(self.nodeB)]
+
     def start(self):
-        self.container_exec(self.nodeA, "iptables -A INPUT -s {} -j DROP".format(self.nodeB) )
-        self.container_exec(self.nodeA, "iptables -A OUTPUT -s {} -j DROP".format(self.nodeB) )
+        self.started_at = self.apply_rules(self.nodeA, 'A', self.rules())
 
     def stop(self):
-        self.container_exec(self.nodeA, "iptables -D INPUT -s {} -j DROP".format(self.nodeB))
-        self.container_exec(self.nodeA, "iptables -D OUTPUT -s {} -j DROP".format(self.nodeB))
+        self.stopped_at = self.apply_rules(self.nodeA, 'D', self.rules())
+
+
+class LinkDegradation(FailureInjector):
+    # Shape traffic from nodeA to nodeB, and back as well if symmetric,
+    # with tc netem; netem is a string of netem options, e.g.
+    # 'delay 50ms 10ms loss 1% rate 10mbit'. With a delay D in both
+    # directions round trip time grows by 2D. Only packets to the peer go
+    # through netem: they are steered to an extra band of a prio qdisc.
+    # The root qdisc of eth0 is replaced, so a node can take part in one
+    # degraded link at a time.
+
+    def __init__(self, nodeA, nodeB, netem, symmetric=True):
+        self.nodeA = nodeA
+        self.nodeB = nodeB
+        self.netem = netem
+        self.symmetric = symmetric
+        super().__init__()
+
+    def node_ip(self, node):
+        networks = self.docker_api.containers.get(node).attrs['NetworkSettings']['Networks']
+        return next(iter(networks.values()))['IPAddress']
+
+    def links(self):
+        if self.symmetric:
+            return [(self.nodeA, self.nodeB), (self.nodeB, self.nodeA)]
+        return [(self.nodeA, self.nodeB)]
+
+    def start(self):
+        # replace rather than add, so that leftovers of an interrupted run
+        # are taken over. A failed link undoes the ones already shaped and
+        # whatever part of itself got through; errors of that cleanup would
+        # only hide the original one.
+        touched = []
+        try:
+            for node, peer in self.links():
+                touched.append(node)
+                self.started_at = self.exec_script(node, 'netem %s to %s' % (self.netem, peer), ' && '.join([
+                    'tc qdisc replace dev eth0 root handle 1: prio bands 4 priomap 1 2 2 2 1 2 0 0 1 1 1 1 1 1 1 1',
+                    'tc qdisc replace dev eth0 parent 1:4 handle 40: netem ' + self.netem,
+                    'tc filter replace dev eth0 protocol ip parent 1: prio 1 handle 800::800 u32 match ip dst %s/32 flowid 1:4' %
+                        self.node_ip(peer)
+                ]))
+        except Exception:
+            for node in touched:
+                self.exec_script(node, 'netem removal', 'tc qdisc del dev eth0 root 2>/dev/null; true')
+            raise
+
+    def stop(self):
+        for node, peer in self.links():
+            self.stopped_at = self.exec_script(node, 'netem removal', 'tc qdisc del dev eth0 root')
+
+
+class LinkDelay(LinkDegradation):
+    # delay and jitter in milliseconds, in every shaped direction
+
+    def __init__(self, nodeA, nodeB, delay, jitter=0, symmetric=True):
+        super().__init__(nodeA, nodeB, 'delay %gms %gms' % (delay, jitter), symmetric)
+
+
+class LinkLoss(LinkDegradation):
+
+    def __init__(self, nodeA, nodeB, percent, symmetric=True):
+        super().__init__(nodeA, nodeB, 'loss %g%%' % percent, symmetric)
+
+
+class LinkBandwidth(LinkDegradation):
+    # rate in tc units, e.g. '10mbit'
+
+    def __init__(self, nodeA, nodeB, rate, symmetric=True):
+        super().__init__(nodeA, nodeB, 'rate %s' % rate, symmetric)
 
 
 class RestartNode(FailureInjector):
@@ -77,11 +174,47 @@ class CrashRecoverNode(FailureInjector):
 
 
 class SkewTime(FailureInjector):
-
-    def __init__(self, node):
+    # Move clock of a node by delta milliseconds and move it back on stop.
+    # Containers share the kernel clock, so the node's processes get the
+    # offset from libfaketime (/pg/faketime, see Dockerfile) instead; other
+    # nodes and the host keep real time. Nodes preload libfaketime only
+    # when MTM_TEST_CLOCK_SKEW is set for the cluster. libfaketime rereads
+    # the offset once a second, so the skew lands up to a second after the
+    # printed window. multimaster timeShift of the node (in microseconds)
+    # is recorded in time_shifts before and after each change.
+
+    def __init__(self, node, delta=1000):
         self.node = node
+        self.delta = delta
+        self.time_shifts = []
         super().__init__()
 
+    def record_time_shift(self, moment):
+        output = self.docker_api.containers.get(self.node).exec_run(
+            ['psql', '-d', 'regression', '-Atc', 'select "timeShift" from mtm.get_cluster_state()'],
+            user='postgres')
+        try:
+            time_shift = int(output)
+        except ValueError:
+            time_shift = None
+        self.time_shifts.append((moment, time_shift))
+        print('timeShift of %s %s: %s' % (self.node, moment, time_shift))
+
+    def set_offset(self, delta):
+        return self.exec_script(self.node, 'clock offset of %gms' % delta,
+            'echo %+.3f > /pg/faketime' % (delta / 1000.0))
+
+    def start(self):
+        self.record_time_shift('before skew')
+        self.started_at = self.set_offset(self.delta)
+        time.sleep(1)
+        self.record_time_shift('after skew')
+
+    def stop(self):
+        self.stopped_at = self.set_offset(0)
+        time.sleep(1)
+        self.record_time_shift('after restore')
+
 class StopNode(FailureInjector):
 
     def __init__(self, node):
@@ -3,15 +3,39 @@ import time
 import datetime
 import psycopg2
 
+from lib.bank_client import MtmClient
+from lib.cluster import ComposeCluster
+from lib.connection_pool import pool
+
 TEST_WARMING_TIME = 5
 TEST_DURATION = 10
 TEST_MAX_RECOVERY_TIME = 300
-TEST_RECOVERY_TIME = 30
-TEST_SETUP_TIME = 20
 TEST_STOP_DELAY = 5
+# first and longest pause between cluster state polls
+TEST_POLL_INTERVAL = 0.1
+TEST_MAX_POLL_INTERVAL = 2
+# after a failure the commit rate of a node over TEST_RATE_WINDOW seconds
+# has to get back to this share of the rate before the failure
+TEST_RECOVERY_RATE = 0.5
+TEST_RATE_WINDOW = 2
 
 class TestHelper(object):
 
+    @classmethod
+    def startCluster(cls, compose_file, project):
+        # Start cls.cluster and cls.client. The first class to run with a
+        # given image and compose file snapshots the initialized cluster;
+        # the following ones start from that snapshot.
+        cls.cluster = ComposeCluster(compose_file, project)
+        restored = cls.cluster.up()
+
+        cls.client = MtmClient(cls.cluster.dsns, n_accounts=1000)
+        cls.awaitOnline(cls.client.dsns)
+        if not restored:
+            pool.discard()
+            cls.cluster.snapshot()
+            cls.awaitOnline(cls.client.dsns)
+
     def assertIsolation(self, aggs):
         isolated = True
         for conn_id, agg in enumerate(aggs):
@@ -36,22 +60,83 @@ class TestHelper(object):
             raise AssertionError('There are commits during aggregation interval')
 
     def awaitCommit(self, node_id):
-        total_sleep = 0
-
-        while total_sleep <= TEST_MAX_RECOVERY_TIME:
-            aggs = self.client.get_aggregates(clean=False, _print=False)
-            # print('=== ',aggs[node_id]['transfer']['finish'])
-            if ('commit' in aggs[node_id]['transfer']['finish'] and
-                    aggs[node_id]['transfer']['finish']['commit'] > 10):
-                break
-            time.sleep(5)
-            total_sleep += 5
-
-
-    def performFailure(self, failure, wait=0, node_wait_for_commit=-1):
+        waited = self.client.wait_for_commits(node_id, 10, timeout=TEST_MAX_RECOVERY_TIME)
+        if waited is not None:
+            print('Node %d commits after %.1fs' % (node_id + 1, waited))
+
+    def awaitCommitRate(self, baseline, nodes):
+        # Wait until the commit rate of every node of nodes recovers to
+        # TEST_RECOVERY_RATE of its baseline rate; a node that had no
+        # baseline has to commit anything.
+        deadline = time.time() + TEST_MAX_RECOVERY_TIME
+        started = time.time()
+        for node_id in nodes:
+            timeout = max(0, deadline - time.time())
+            if baseline[node_id] > 0:
+                waited = self.client.wait_for_commit_rate(node_id,
+                    baseline[node_id] * TEST_RECOVERY_RATE, TEST_RATE_WINDOW, timeout)
+            else:
+                waited = self.client.wait_for_commits(node_id, 1, timeout)
+            if waited is None:
+                raise AssertionError('Commit rate of node %d did not recover in %d seconds' %
+                    (node_id + 1, TEST_MAX_RECOVERY_TIME))
+        print('Commit rate recovered after %.1fs' % (time.time() - started))
+
+    @staticmethod
+    def nodeState(dsn):
+        # (mtm.get_cluster_state(), mtm.get_nodes_state()) of a node as
+        # dicts, or None if the node does not answer.
+        try:
+            with pool.connection(dsn) as con:
+                cur = con.cursor()
+                cur.execute('select * from mtm.get_cluster_state()')
+                names = [desc[0] for desc in cur.description]
+                cluster = dict(zip(names, cur.fetchone()))
+                cur.execute('select * from mtm.get_nodes_state()')
+                names = [desc[0] for desc in cur.description]
+                nodes = [dict(zip(names, row)) for row in cur.fetchall()]
+                cur.close()
+        except psycopg2.Error:
+            return None
+        return (cluster, nodes)
+
+    @classmethod
+    def awaitOnline(cls, dsns, nodes=None, timeout=TEST_MAX_RECOVERY_TIME):
+        # Poll nodes with backoff until every node of nodes (indexes into
+        # dsns, all by default) is online, enabled and connected to the
+        # others, and none of them is catching up.
+        nodes = range(len(dsns)) if nodes is None else nodes
+        mask = sum(1 << i for i in nodes)
+        deadline = time.time() + timeout
+        interval = TEST_POLL_INTERVAL
+
+        while True:
+            states = [cls.nodeState(dsns[i]) for i in nodes]
+            if all(state is not None
+                    and state[0]['status'] == 'Online'
+                    and state[0]['liveNodes'] >= len(nodes)
+                    and state[0]['disabledNodeMask'] & mask == 0
+                    and state[0]['catchUpNodeMask'] == 0
+                    and all(node['enabled'] and node['connected']
+                        for node in state[1] if mask & (1 << (node['id'] - 1)))
+                    for state in states):
+                print('Nodes online at ', datetime.datetime.utcnow())
+                return
+
+            if time.time() + interval > deadline:
+                raise AssertionError('Nodes are not online after %d seconds: %s' %
+                    (timeout, [state and state[0] for state in states]))
+            time.sleep(interval)
+            interval = min(interval * 2, TEST_MAX_POLL_INTERVAL)
+
+    def performFailure(self, failure, wait=0, node_wait_for_commit=-1, online_after=None):
+        # online_after: indexes of nodes expected to recover once the
+        # failure is stopped, all nodes by default.
 
         time.sleep(TEST_WARMING_TIME)
-         
+        baseline = [self.client.commit_rate(node_id, TEST_RATE_WINDOW)
+            for node_id in range(len(self.client.dsns))]
+
         print('Simulate failure at ',datetime.datetime.utcnow())
 
         failure.start()
@@ -72,19 +157,19 @@ class TestHelper(object):
 
         self.client.clean_aggregates()
 
+        self.awaitOnline(self.client.dsns, online_after)
         if node_wait_for_commit >= 0:
             self.awaitCommit(node_wait_for_commit)
         else:
-            time.sleep(TEST_RECOVERY_TIME)
+            self.awaitCommitRate(baseline,
+                range(len(self.client.dsns)) if online_after is None else online_after)
 
         aggs = self.client.get_aggregates()
         return (aggs_failure, aggs)
 
     def nodeExecute(dsn, statements):
-        con = psycopg2.connect(dsn)
-        con.autocommit = True
-        cur = con.cursor()
-        for statement in statements:
-            cur.execute(statement)
-        cur.close()
-        con.close()
+        with pool.connection(dsn) as con:
+            cur = con.cursor()
+            for statement in statements:
+                cur.execute(statement)
+            cur.close()
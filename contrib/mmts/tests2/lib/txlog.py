@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# Compact binary log of every transaction issued by MtmClient workers.
+#
+# File starts with a header (magic, version, seed, wall clock and monotonic
+# clock at open time), followed by fixed size records. Timestamps are
+# monotonic nanoseconds; add (wall_ns - mono_ns) from the header to get
+# wall clock time. Dump a log as text with:
+#
+#   python3 -m lib.txlog <file> [<file> ...]
+#
+
+import struct
+import sys
+import time
+
+HEADER = struct.Struct('<8sHqqq')
+RECORD = struct.Struct('<HHHIiiBqq')
+MAGIC = b'MTMTXLOG'
+VERSION = 1
+
+# kind and outcome codes of a record
+TX_KINDS = ['transfer', 'sumtotal']
+TX_OUTCOMES = ['commit']
+
+class TxLogWriter(object):
+
+    def __init__(self, path, seed, outcomes, now_ns):
+        # outcomes: names of outcome codes after 'commit'
+        self.outcome_codes = dict((name, i) for i, name in enumerate(TX_OUTCOMES + outcomes))
+        self.kind_codes = dict((name, i) for i, name in enumerate(TX_KINDS))
+        self.file = open(path, 'wb', buffering=1 << 20)
+        self.file.write(HEADER.pack(MAGIC, VERSION, -1 if seed is None else seed,
+            int(time.time() * 1000000000), now_ns()))
+
+    def write(self, kind, conn_i, worker_i, seq, pair, outcome, start_ns, end_ns):
+        from_uid, to_uid = pair if pair is not None else (0, 0)
+        self.file.write(RECORD.pack(self.kind_codes[kind], conn_i, worker_i, seq,
+            from_uid, to_uid, self.outcome_codes[outcome], start_ns, end_ns))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_txlog(path, outcomes):
+    # Yields (header dict, None) first, then one dict per record.
+    names = TX_OUTCOMES + outcomes
+    with open(path, 'rb') as f:
+        magic, version, seed, wall_ns, mono_ns = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a transaction log' % path)
+        yield {'seed': None if seed == -1 else seed, 'wall_ns': wall_ns, 'mono_ns': mono_ns}
+
+        while True:
+            data = f.read(RECORD.size)
+            if len(data) < RECORD.size:
+                # the last record may be torn if the writer was killed
+                return
+            kind, conn_i, worker_i, seq, from_uid, to_uid, outcome, start_ns, end_ns = \
+                RECORD.unpack(data)
+            yield {
+                'kind': TX_KINDS[kind],
+                'node': conn_i + 1,
+                'worker': worker_i,
+                'seq': seq,
+                'from_uid': from_uid,
+                'to_uid': to_uid,
+                'outcome': names[outcome],
+                'start_ns': start_ns,
+                'end_ns': end_ns
+            }
+
+if __name__ == '__main__':
+    from lib.bank_client import ABORT_REASONS
+
+    for path in sys.argv[1:]:
+        records = read_txlog(path, ABORT_REASONS)
+        header = next(records)
+        print('# %s: seed %s' % (path, header['seed']))
+        # sort by worker and sequence so that logs of two runs diff cleanly
+        for r in sorted(records, key=lambda r: (r['kind'], r['node'], r['worker'], r['seq'])):
+            print('%s\t%d\t%d\t%d\t%d\t%d\t%s\t%.3f' % (r['kind'], r['node'], r['worker'],
+                r['seq'], r['from_uid'], r['to_uid'], r['outcome'],
+                (r['end_ns'] - r['start_ns']) / 1000000.0))
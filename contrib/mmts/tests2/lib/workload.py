@@ -0,0 +1,123 @@
+import array
+import numpy
+
+class KeyGenerator(object):
+    # Source of (from_uid, to_uid) account pairs for transfer_tx. Pairs are
+    # generated with vectorized numpy calls a block at a time, so a
+    # transaction only advances a cursor. The stream is fully defined by
+    # seed, which allows to replay a run. Subclasses define the
+    # distribution in generate().
+
+    def __init__(self, n_accounts, block_size=65536, seed=None):
+        self.n_accounts = n_accounts
+        self.block_size = block_size
+        self.seed = seed
+        self.rng = numpy.random.RandomState(seed)
+        self.refill()
+
+    def refill(self):
+        from_uids, to_uids = self.generate(self.rng, self.block_size)
+        # psycopg2 can not adapt numpy scalars; array('q') hands out plain
+        # ints and takes 8 bytes per key, which matters with many workers
+        self.from_uids = array.array('q', from_uids.astype(numpy.int64).tobytes())
+        self.to_uids = array.array('q', to_uids.astype(numpy.int64).tobytes())
+        self.cursor = 0
+
+    def next_pair(self):
+        if self.cursor == self.block_size:
+            self.refill()
+        i = self.cursor
+        self.cursor = i + 1
+        return self.from_uids[i], self.to_uids[i]
+
+    def adjacent(self, from_uids):
+        # Transfer to the next account. Locks are always taken in uid order,
+        # so transfers never deadlock.
+        from_uids = numpy.clip(from_uids, 1, self.n_accounts - 2)
+        return from_uids, from_uids + 1
+
+class UniformKeys(KeyGenerator):
+
+    def generate(self, rng, size):
+        return self.adjacent(rng.randint(1, self.n_accounts - 1, size))
+
+# (n, theta) -> (zetan, zeta2, alpha, eta); every transfer worker has its
+# own generator, but the O(n) zeta sum is done once per process
+zipfian_constants = {}
+
+class ZipfianKeys(KeyGenerator):
+    # Zipfian ranks after Gray et al., "Quickly generating billion-record
+    # synthetic databases" (the YCSB generator), 0 < theta < 1. Ranks are
+    # scattered over the table so hot accounts do not share pages.
+
+    def __init__(self, n_accounts, theta=0.99, **kwargs):
+        if not 0 < theta < 1:
+            raise ValueError('zipfian theta must be in (0, 1)')
+        # constants do not depend on the block, compute them once
+        n = n_accounts - 2
+        self.theta = theta
+        if (n, theta) not in zipfian_constants:
+            zetan = numpy.sum(1.0 / numpy.arange(1, n + 1) ** theta)
+            zeta2 = 1 + 0.5 ** theta
+            zipfian_constants[(n, theta)] = (zetan, zeta2, 1.0 / (1.0 - theta),
+                (1 - (2.0 / n) ** (1 - theta)) / (1 - zeta2 / zetan))
+        self.zetan, self.zeta2, self.alpha, self.eta = zipfian_constants[(n, theta)]
+        super().__init__(n_accounts, **kwargs)
+
+    def generate(self, rng, size):
+        n = self.n_accounts - 2
+        zetan, zeta2, alpha, eta = self.zetan, self.zeta2, self.alpha, self.eta
+
+        u = rng.random_sample(size)
+        uz = u * zetan
+        ranks = numpy.where(uz < 1, 0,
+            numpy.where(uz < zeta2, 1,
+                (n * (eta * u - eta + 1) ** alpha).astype(numpy.int64)))
+        ranks = numpy.minimum(ranks, n - 1)
+
+        return self.adjacent(1 + (ranks * 2654435761) % n)
+
+class HotSpotKeys(KeyGenerator):
+    # hot_probability of transfers go to the first hot_fraction of accounts
+
+    def __init__(self, n_accounts, hot_fraction=0.01, hot_probability=0.9, **kwargs):
+        self.hot_fraction = hot_fraction
+        self.hot_probability = hot_probability
+        super().__init__(n_accounts, **kwargs)
+
+    def generate(self, rng, size):
+        n_hot = max(1, int((self.n_accounts - 2) * self.hot_fraction))
+        hot = rng.random_sample(size) < self.hot_probability
+        from_uids = numpy.where(hot,
+            rng.randint(1, n_hot + 1, size),
+            rng.randint(1, self.n_accounts - 1, size))
+        return self.adjacent(from_uids)
+
+class ConflictingKeys(KeyGenerator):
+    # Transfers between two distinct accounts of a small set shared by all
+    # nodes, in random order. Concurrent transactions on different nodes
+    # update the same rows in opposite order, which exercises multimaster
+    # conflict and deadlock detection.
+
+    def __init__(self, n_accounts, n_keys=16, **kwargs):
+        self.n_keys = n_keys
+        super().__init__(n_accounts, **kwargs)
+
+    def generate(self, rng, size):
+        n_keys = max(2, min(self.n_keys, self.n_accounts - 2))
+        from_uids = rng.randint(1, n_keys + 1, size)
+        shift = rng.randint(1, n_keys, size)
+        to_uids = 1 + (from_uids - 1 + shift) % n_keys
+        return from_uids, to_uids
+
+key_distributions = {
+    'uniform': UniformKeys,
+    'zipfian': ZipfianKeys,
+    'hotspot': HotSpotKeys,
+    'conflicting': ConflictingKeys,
+}
+
+def key_generator(distribution, n_accounts, **kwargs):
+    if distribution not in key_distributions:
+        raise ValueError('unknown key distribution %r' % (distribution,))
+    return key_distributions[distribution](n_accounts, **kwargs)
@@ -0,0 +1,232 @@
+#
+# Checks of the pure Python parts of lib/, no cluster needed:
+#
+#   python3 -m unittest test_lib
+#
+
+import asyncio
+import os
+import pickle
+import random
+import tempfile
+import unittest
+
+import psycopg2
+import psycopg2.extensions
+
+from lib.bank_client import LatencyHistogram, subrange, ABORT_REASONS, now_ns, abort_classifier
+from lib.txlog import TxLogWriter, read_txlog, RECORD
+from lib.workload import key_generator, key_distributions
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_bucket_bounds(self):
+        rnd = random.Random(0)
+        hist = LatencyHistogram()
+        for value in list(range(1000)) + [rnd.randrange(1 << 35) for i in range(10000)]:
+            index = hist._index(value)
+            # a bucket holds values up to its upper bound, and the previous
+            # bucket ends right before it
+            self.assertLessEqual(value, hist._value_at(index))
+            if index > 0:
+                self.assertGreater(value, hist._value_at(index - 1))
+
+    def test_small_values_are_exact(self):
+        hist = LatencyHistogram()
+        for value in range(2 * hist.half):
+            self.assertEqual(hist._value_at(hist._index(value)), value)
+
+    def test_percentile_error(self):
+        rnd = random.Random(1)
+        values = sorted(int(rnd.lognormvariate(8, 1.5)) for i in range(100000))
+        hist = LatencyHistogram()
+        for value in values:
+            hist.record(value)
+
+        self.assertEqual(hist.total_count, len(values))
+        self.assertEqual(hist.min_value, values[0])
+        self.assertEqual(hist.max_value, values[-1])
+        for percent in [50, 90, 99, 99.9]:
+            exact = values[int(round(len(values) * percent / 100.0)) - 1]
+            self.assertLessEqual(abs(hist.percentile(percent) - exact),
+                exact * 2.0 ** (1 - hist.sub_bits))
+        self.assertEqual(hist.percentile(100), values[-1])
+
+    def test_empty(self):
+        hist = LatencyHistogram()
+        self.assertEqual(hist.percentile(99), 0)
+        self.assertEqual(hist.merge(LatencyHistogram()).total_count, 0)
+
+    def test_merge(self):
+        rnd = random.Random(2)
+        a, b, both = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+        for i in range(10000):
+            value = rnd.randrange(1 << 30)
+            (a if i % 3 else b).record(value)
+            both.record(value)
+
+        a.merge(b)
+        self.assertEqual(a.counts, both.counts)
+        self.assertEqual((a.total_count, a.min_value, a.max_value),
+            (both.total_count, both.min_value, both.max_value))
+        with self.assertRaises(ValueError):
+            a.merge(LatencyHistogram(sub_bits=5))
+
+    def test_pickle(self):
+        hist = LatencyHistogram()
+        for value in [5, 700, 700, 123456, 1 << 33]:
+            hist.record(value)
+
+        copy = pickle.loads(pickle.dumps(hist))
+        self.assertEqual(copy.counts, hist.counts)
+        self.assertEqual(copy.as_dict(), hist.as_dict())
+        # only the used buckets are shipped
+        self.assertLess(len(pickle.dumps(hist)), len(hist.counts))
+
+
+# psycopg2 errors take pgcode from the server only
+class SerializationFailure(psycopg2.extensions.TransactionRollbackError):
+    pgcode = '40001'
+
+class MultimasterError(psycopg2.InternalError):
+    pgcode = 'XX000'
+
+
+class AbortClassifierTest(unittest.TestCase):
+
+    def assertReason(self, error, reason):
+        self.assertIn(reason, ABORT_REASONS)
+        self.assertEqual(abort_classifier.classify(error), reason)
+
+    def test_sqlstate(self):
+        # SQLSTATE wins over whatever the message says
+        self.assertReason(SerializationFailure('could not serialize access, timeout'),
+            'serialization')
+
+    def test_multimaster_messages(self):
+        self.assertReason(MultimasterError('Transaction MTM-1-1234-5 (5678) is aborted '
+            'on node 2. Check its log to see error details.'), 'aborted_on_node')
+        self.assertReason(MultimasterError('Multimaster node is not online: '
+            'current status Recovery'), 'node_not_online')
+
+    def test_python_errors(self):
+        self.assertReason(AssertionError('total changed'), 'assertion')
+        self.assertReason(asyncio.TimeoutError(), 'timeout')
+
+    def test_other(self):
+        self.assertReason(MultimasterError('division by zero'), 'other')
+        self.assertReason(ValueError('bad value'), 'other')
+
+
+class SubrangeTest(unittest.TestCase):
+
+    def check(self, lo, hi, fanout):
+        # subranges must tile [lo, hi) in part order and hold exactly the
+        # uids the SQL of range_hashes() assigns to each part
+        start = lo
+        for part in range(fanout):
+            sub_lo, sub_hi = subrange(lo, hi, fanout, part)
+            self.assertEqual(sub_lo, start)
+            for uid in range(sub_lo, sub_hi):
+                self.assertEqual((uid - lo) * fanout // (hi - lo), part)
+            start = sub_hi
+        self.assertEqual(start, hi)
+
+    def test_even_split(self):
+        self.check(1, 1025, 64)
+        self.check(0, 64, 64)
+
+    def test_uneven_split(self):
+        rnd = random.Random(3)
+        for i in range(200):
+            lo = rnd.randrange(100000)
+            self.check(lo, lo + rnd.randrange(1, 5000), rnd.choice([2, 7, 64]))
+
+    def test_fewer_uids_than_parts(self):
+        # some parts are empty, none overlaps
+        self.check(10, 13, 64)
+
+
+class TxLogTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_round_trip(self):
+        writer = TxLogWriter(self.path, 42, ABORT_REASONS, now_ns)
+        writer.write('transfer', 0, 3, 1, (10, 11), 'commit', 100, 250)
+        writer.write('transfer', 2, 0, 7, (5, 1), 'deadlock', 300, 900)
+        writer.write('sumtotal', 1, 0, 2, None, 'other', 1000, 1001)
+        writer.close()
+
+        records = read_txlog(self.path, ABORT_REASONS)
+        self.assertEqual(next(records)['seed'], 42)
+        self.assertEqual([(r['kind'], r['node'], r['worker'], r['seq'], r['from_uid'],
+                r['to_uid'], r['outcome'], r['start_ns'], r['end_ns']) for r in records], [
+            ('transfer', 1, 3, 1, 10, 11, 'commit', 100, 250),
+            ('transfer', 3, 0, 7, 5, 1, 'deadlock', 300, 900),
+            ('sumtotal', 2, 0, 2, 0, 0, 'other', 1000, 1001)
+        ])
+
+    def test_unseeded_and_torn_tail(self):
+        writer = TxLogWriter(self.path, None, ABORT_REASONS, now_ns)
+        writer.write('transfer', 0, 0, 1, (1, 2), 'commit', 1, 2)
+        writer.close()
+        # a writer killed mid-record leaves a partial record behind
+        with open(self.path, 'ab') as f:
+            f.write(b'\0' * (RECORD.size // 2))
+
+        records = list(read_txlog(self.path, ABORT_REASONS))
+        self.assertIsNone(records[0]['seed'])
+        self.assertEqual(len(records), 2)
+
+    def test_not_a_log(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * 64)
+        with self.assertRaises(ValueError):
+            next(read_txlog(self.path, ABORT_REASONS))
+
+
+class KeyGeneratorTest(unittest.TestCase):
+    # small blocks, so that every stream below crosses a few refills
+    n_accounts = 1000
+    block_size = 100
+    n_pairs = 350
+
+    def pairs(self, distribution, seed):
+        keys = key_generator(distribution, self.n_accounts,
+            block_size=self.block_size, seed=seed)
+        return [keys.next_pair() for i in range(self.n_pairs)]
+
+    def test_same_seed_same_stream(self):
+        for distribution in key_distributions:
+            with self.subTest(distribution=distribution):
+                self.assertEqual(self.pairs(distribution, [42, 1, 3]),
+                    self.pairs(distribution, [42, 1, 3]))
+
+    def test_workers_get_own_streams(self):
+        for distribution in key_distributions:
+            with self.subTest(distribution=distribution):
+                streams = [self.pairs(distribution, [42, node, worker])
+                    for node in range(2) for worker in range(2)]
+                for i in range(len(streams)):
+                    for j in range(i):
+                        self.assertNotEqual(streams[i], streams[j])
+
+    def test_key_bounds(self):
+        for distribution in key_distributions:
+            with self.subTest(distribution=distribution):
+                for from_uid, to_uid in self.pairs(distribution, [7, 0, 0]):
+                    self.assertIsInstance(from_uid, int)
+                    self.assertTrue(1 <= from_uid <= self.n_accounts - 1)
+                    self.assertTrue(1 <= to_uid <= self.n_accounts - 1)
+                    self.assertNotEqual(from_uid, to_uid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,24 +18,11 @@ class MajorTest(unittest.TestCase, TestHelper):
 
     @classmethod
     def setUpClass(cls):
-        subprocess.check_call(['docker-compose',
-            '-f', 'support/two_nodes.yml',
-            'up',
-            '--force-recreate',
-            '--build',
-            '-d'])
-
-        # XXX: add normal wait here
-        time.sleep(TEST_SETUP_TIME)
-
-        cls.client = MtmClient([
-            "dbname=regression user=postgres host=127.0.0.1 port=15432",
-            "dbname=regression user=postgres host=127.0.0.1 port=15433"
-        ], n_accounts=1000)
+        cls.startCluster('support/two_nodes.yml', 'major')
         cls.client.bgrun()
 
         # create extension on referee
-        cls.nodeExecute("dbname=regression user=postgres host=127.0.0.1 port=15435", ['create extension multimaster'])
+        cls.nodeExecute(cls.cluster.dsn('referee'), ['create extension multimaster'])
 
     @classmethod
     def tearDownClass(cls):
@@ -51,11 +38,11 @@ class MajorTest(unittest.TestCase, TestHelper):
             raise AssertionError('There are some uncommitted tx')
 
         # XXX: check nodes data identity here
-        # subprocess.check_call(['docker-compose','down'])
+        # cls.cluster.down()
 
     def setUp(self):
         warnings.simplefilter("ignore", ResourceWarning)
-        time.sleep(20)
+        self.awaitOnline(self.client.dsns)
         print('Start new test at ',datetime.datetime.utcnow())
 
     def tearDown(self):
@@ -69,7 +56,7 @@ class MajorTest(unittest.TestCase, TestHelper):
             'select pg_reload_conf()'
         ])
 
-        aggs_failure, aggs = self.performFailure(SingleNodePartition('node2'))
+        aggs_failure, aggs = self.performFailure(SingleNodePartition(self.cluster.container('node2')))
 
         self.assertCommits(aggs_failure[:1])
         self.assertNoCommits(aggs_failure[1:])
@@ -18,21 +18,11 @@ class RefereeTest(unittest.TestCase, TestHelper):
 
     @classmethod
     def setUpClass(cls):
-        subprocess.check_call(['docker-compose',
-            '-f', 'support/two_nodes.yml',
-            'up',
-            '--force-recreate',
-            '--build',
-            '-d'])
-
-        cls.client = MtmClient([
-            "dbname=regression user=postgres host=127.0.0.1 port=15432",
-            "dbname=regression user=postgres host=127.0.0.1 port=15433"
-        ], n_accounts=1000)
+        cls.startCluster('support/two_nodes.yml', 'referee')
         cls.client.bgrun()
 
         # create extension on referee
-        cls.nodeExecute("dbname=regression user=postgres host=127.0.0.1 port=15435", ['create extension referee'])
+        cls.nodeExecute(cls.cluster.dsn('referee'), ['create extension referee'])
 
     @classmethod
     def tearDownClass(cls):
@@ -46,11 +36,11 @@ class RefereeTest(unittest.TestCase, TestHelper):
             raise AssertionError('There are some uncommitted tx')
 
         # XXX: check nodes data identity here
-        # subprocess.check_call(['docker-compose','down'])
+        # cls.cluster.down()
 
     def setUp(self):
         warnings.simplefilter("ignore", ResourceWarning)
-
+        self.awaitOnline(self.client.dsns)
         print('Start new test at ',datetime.datetime.utcnow())
 
     def tearDown(self):
@@ -59,7 +49,7 @@ class RefereeTest(unittest.TestCase, TestHelper):
     def test_node_crash(self):
         print('### test_node_crash ###')
 
-        aggs_failure, aggs = self.performFailure(CrashRecoverNode('node2'), node_wait_for_commit=1)
+        aggs_failure, aggs = self.performFailure(CrashRecoverNode(self.cluster.container('node2')), node_wait_for_commit=1)
 
         self.assertCommits(aggs_failure[:1])
         self.assertNoCommits(aggs_failure[1:])
@@ -72,7 +62,7 @@ class RefereeTest(unittest.TestCase, TestHelper):
     def test_partition_referee(self):
         print('### test_partition_referee ###')
 
-        aggs_failure, aggs = self.performFailure(SingleNodePartition('node2'), node_wait_for_commit=1)
+        aggs_failure, aggs = self.performFailure(SingleNodePartition(self.cluster.container('node2')), node_wait_for_commit=1)
 
         self.assertCommits(aggs_failure[:1])
         self.assertNoCommits(aggs_failure[1:])
@@ -84,7 +74,7 @@ class RefereeTest(unittest.TestCase, TestHelper):
     def test_double_failure_referee(self):
         print('### test_double_failure_referee ###')
 
-        aggs_failure, aggs = self.performFailure(SingleNodePartition('node2'), node_wait_for_commit=1)
+        aggs_failure, aggs = self.performFailure(SingleNodePartition(self.cluster.container('node2')), node_wait_for_commit=1)
 
         self.assertCommits(aggs_failure[:1])
         self.assertNoCommits(aggs_failure[1:])
@@ -93,7 +83,7 @@ class RefereeTest(unittest.TestCase, TestHelper):
         self.assertCommits(aggs)
         self.assertIsolation(aggs)
 
-        aggs_failure, aggs = self.performFailure(SingleNodePartition('node1'), node_wait_for_commit=0)
+        aggs_failure, aggs = self.performFailure(SingleNodePartition(self.cluster.container('node1')), node_wait_for_commit=0)
 
         self.assertNoCommits(aggs_failure[:1])
         self.assertCommits(aggs_failure[1:])
@@ -106,7 +96,7 @@ class RefereeTest(unittest.TestCase, TestHelper):
     def test_winner_restart(self):
         print('### test_winner_restart ###')
 
-        aggs_failure, aggs = self.performFailure(StopNode('node1'))
+        aggs_failure, aggs = self.performFailure(StopNode(self.cluster.container('node1')), online_after=[1])
 
         self.assertNoCommits(aggs_failure[:1])
         self.assertCommits(aggs_failure[1:])
@@ -116,7 +106,8 @@ class RefereeTest(unittest.TestCase, TestHelper):
         self.assertCommits(aggs[1:])
         self.assertIsolation(aggs)
 
-        aggs_failure, aggs = self.performFailure(RestartNode('node2'), node_wait_for_commit=1)
+        aggs_failure, aggs = self.performFailure(RestartNode(self.cluster.container('node2')), node_wait_for_commit=1,
+            online_after=[1])
 
         self.assertNoCommits(aggs_failure)
         self.assertIsolation(aggs_failure)
@@ -127,7 +118,7 @@ class RefereeTest(unittest.TestCase, TestHelper):
 
         # need to start node1 to perform consequent tests
         docker_api = docker.from_env()
-        docker_api.containers.get('node1').start()
+        docker_api.containers.get(self.cluster.container('node1')).start()
         self.awaitCommit(0)
 
 
@@ -1,27 +1,33 @@
 import unittest
 import subprocess
-import time
+
+from lib.bank_client import keep_trying
+from lib.cluster import ComposeCluster
+from lib.connection_pool import pool
+from lib.test_helper import TestHelper
 
 class RecoveryTest(unittest.TestCase):
 
     @classmethod
     def setUpClass(self):
         print('setUp')
-        subprocess.check_call(['docker-compose','up',
-           '--force-recreate',
-           '--build',
-           '-d'])
+        self.cluster = ComposeCluster('docker-compose.yml', 'regression')
+        self.cluster.up(restore=False)
+
+        # pg_regress checks the catalog of the regression database, so only
+        # wait until every node takes connections and leave it untouched
+        for dsn in self.cluster.dsns:
+            keep_trying(40, 1, TestHelper.nodeExecute, 'connect', dsn, ['select 1'])
+        pool.discard()
 
     @classmethod
     def tearDownClass(self):
         print('tearDown')
-#        subprocess.check_call(['docker-compose','down'])
+#        self.cluster.down()
 
     def test_regression(self):
-        # XXX: make smth clever here
-        time.sleep(31)
         subprocess.check_call(['docker', 'exec',
-            'node1',
+            self.cluster.container('node1'),
             '/pg/mmts/tests2/support/docker-regress.sh',
         ])
 